@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 import chess
 import chess.engine
+import chess.syzygy
+import os
+import time
 import asyncio
 import logging
 
@@ -14,6 +17,13 @@ logging.basicConfig(
     level=logging.DEBUG, format="[%(levelname)s] (%(name)s) %(message)s"
 )
 
+# seconds between full-board resynchronisations
+RESYNC_INTERVAL = 1.0
+# directory of Syzygy tablebase files (optional)
+SYZYGY_PATH = "./syzygy"
+# Polyglot opening books, searched in order (optional)
+BOOK_PATHS = ["./book.bin"]
+
 
 async def main():
     if not hw.LUMA:
@@ -24,17 +34,43 @@ async def main():
     red, blue = chain[0], chain[1]
     turn = gp.LED(1), gp.LED(2)
     scanner = hw.Electrode([3, 4, 5], [6, 7, 8])
-    _, engine = await chess.engine.popen_uci("./stockfish")
+    engine = sw.EngineSupervisor("./stockfish")
+    await engine.start()
+    tablebase = None
+    if os.path.isdir(SYZYGY_PATH):
+        tablebase = chess.syzygy.open_tablebase(SYZYGY_PATH)
+    book = None
+    books = [path for path in BOOK_PATHS if os.path.isfile(path)]
+    if books:
+        book = sw.OpeningBook(books)
 
-    game = sw.ChessBoard(blue, red, turn, scanner, engine, 1)
+    game = sw.ChessBoard(blue, red, turn, scanner, engine, 1, tablebase, book)
     print(game, end="\n\n")
 
+    # resync needs a scanner covering the whole board
+    resync = scanner.data.shape == (8, 8)
+    if not resync:
+        logging.warning(
+            f"Scanner covers {scanner.data.shape} squares; resync disabled"
+        )
+
+    last_sync = time.monotonic()
     while game.outcome == None:
-        for x, y in await scanner.scan():
-            game.toggle(x, y)
+        changes = await scanner.scan()
+        if changes:
+            game.apply_scan(changes)
             print(game, end="\n\n")
 
+        if resync and time.monotonic() - last_sync >= RESYNC_INTERVAL:
+            last_sync = time.monotonic()
+            if game.resync():
+                print(game, end="\n\n")
+
     await engine.quit()
+    if tablebase != None:
+        tablebase.close()
+    if book != None:
+        book.close()
 
 
 asyncio.set_event_loop_policy(chess.engine.EventLoopPolicy())
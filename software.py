@@ -1,13 +1,17 @@
 import chess
 import chess.engine
+import chess.syzygy
+import chess.polyglot
+import time
 import asyncio
 import logging
 import functools
+import numpy as np
 import gpiozero as gp
 import hardware as hw
 
 from enum import IntFlag
-from typing import List, Optional, Set, Tuple
+from typing import Dict, List, Optional, Sequence, Set, Tuple
 
 logger = logging.getLogger(__name__)
 
@@ -37,6 +41,203 @@ SELECT   = State.SELECT                  # 4
 # fmt: on
 
 
+class OutcomeTracker:
+    """
+    Tracks game termination as moves are pushed, so that
+    checking outcome costs the same however long the game is.
+    Same result as Board.outcome() (claimable draws are ignored)
+    """
+
+    def __init__(self, board: chess.Board):
+        self.board = board
+        # position hash -> occurrences since the last irreversible move
+        self.repetitions: Dict[int, int] = {}
+        # material only changes by capture or promotion
+        self.insufficient = board.is_insufficient_material()
+        self._count()
+
+    def _count(self):
+        self.key = chess.polyglot.zobrist_hash(self.board)
+        self.repetitions[self.key] = self.repetitions.get(self.key, 0) + 1
+
+    def push(self, move: chess.Move):
+        """
+        Push the move to the board and update tracking data
+        """
+        material = self.board.is_capture(move) or move.promotion != None
+        self.board.push(move)
+
+        if self.board.halfmove_clock == 0:
+            # earlier positions can never appear again
+            self.repetitions.clear()
+        self._count()
+
+        if material:
+            self.insufficient = self.board.is_insufficient_material()
+
+    def outcome(self) -> Optional[chess.Outcome]:
+        """
+        Return outcome of the game, or None if it's still going on
+        """
+        board = self.board
+        # stops at the first legal move instead of generating all of them
+        has_moves = any(board.generate_legal_moves())
+
+        if not has_moves and board.is_check():
+            return chess.Outcome(chess.Termination.CHECKMATE, not board.turn)
+        if self.insufficient:
+            return chess.Outcome(chess.Termination.INSUFFICIENT_MATERIAL, None)
+        if not has_moves:
+            return chess.Outcome(chess.Termination.STALEMATE, None)
+        if board.halfmove_clock >= 150:
+            return chess.Outcome(chess.Termination.SEVENTYFIVE_MOVES, None)
+        if self.repetitions[self.key] >= 5:
+            return chess.Outcome(chess.Termination.FIVEFOLD_REPETITION, None)
+        return None
+
+
+class OpeningBook:
+    """
+    Polyglot opening books, opened once and kept memory-mapped.
+    Books are searched in given order until one has the position
+    """
+
+    def __init__(self, paths: Sequence[str], depth: int = 20, weighted: bool = True):
+        self.readers = [chess.polyglot.open_reader(path) for path in paths]
+        # book isn't used from this ply on
+        self.depth = depth
+        # random move by weight if True, else always the heaviest one
+        self.weighted = weighted
+
+    def lookup(self, board: chess.Board) -> Optional[chess.Move]:
+        """
+        Return book move of the position, or None if out of book
+        """
+        if board.ply() >= self.depth:
+            return None
+
+        for reader in self.readers:
+            try:
+                if self.weighted:
+                    entry = reader.weighted_choice(board)
+                else:
+                    entry = reader.find(board)
+            except IndexError:  # position isn't in this book
+                continue
+            return entry.move
+
+        return None
+
+    def close(self):
+        for reader in self.readers:
+            reader.close()
+
+
+class EngineSupervisor:
+    """
+    Keeps a UCI engine running with a warm standby instance.
+    If the active engine dies, hangs or raises,
+    standby takes over and a new standby is spawned
+    """
+
+    def __init__(self, command: str, grace: float = 5.0, retries: int = 1):
+        self.command = command
+        # seconds allowed on top of the search time before giving up
+        self.grace = grace
+        # how many times a single request is retried on other instances
+        self.retries = retries
+        # number of times the active engine was replaced
+        self.restarts: int = 0
+
+        Engine = Tuple[asyncio.SubprocessTransport, chess.engine.UciProtocol]
+        self.active: Optional[Engine] = None
+        self.standby: Optional["asyncio.Task[Engine]"] = None
+
+    async def start(self):
+        """
+        Spawn the active engine and start spawning standby
+        """
+        self.active = await chess.engine.popen_uci(self.command)
+        self.standby = asyncio.create_task(chess.engine.popen_uci(self.command))
+
+    def alive(self) -> bool:
+        """
+        Return whether the active engine process is still running
+        """
+        if self.active == None:
+            return False
+        transport, _ = self.active
+        return transport.get_returncode() == None
+
+    async def failover(self):
+        """
+        Kill the active engine and promote standby in its place
+        """
+        if self.active != None:
+            transport, _ = self.active
+            transport.close()  # kills the process if it's still running
+        self.restarts += 1
+
+        engine = None
+        if self.standby != None:
+            try:
+                engine = await self.standby
+            except Exception as e:
+                logger.warning(f"Standby engine failed to start: {repr(e)}")
+        if engine == None or engine[0].get_returncode() != None:
+            engine = await chess.engine.popen_uci(self.command)
+
+        self.active = engine
+        self.standby = asyncio.create_task(chess.engine.popen_uci(self.command))
+        logger.info(f"Switched to standby engine ({self.restarts} restarts)")
+
+    async def play(
+        self, board: chess.Board, limit: chess.engine.Limit
+    ) -> chess.engine.PlayResult:
+        """
+        Same as UciProtocol.play(), but each request has a deadline
+        and failed requests are retried on the standby engine
+        """
+        deadline = (limit.time or 0) + self.grace
+        for _ in range(self.retries + 1):
+            if not self.alive():
+                logger.warning("Engine process is dead")
+                await self.failover()
+            assert self.active != None
+
+            _, protocol = self.active
+            try:
+                return await asyncio.wait_for(protocol.play(board, limit), deadline)
+            except asyncio.TimeoutError:
+                logger.warning(f"Engine didn't respond in {deadline}s")
+            except (chess.engine.EngineError, chess.engine.EngineTerminatedError) as e:
+                logger.warning(f"Engine failed: {repr(e)}")
+            await self.failover()
+
+        raise RuntimeError(f"Engine failed {self.retries + 1} times in a row")
+
+    async def quit(self):
+        """
+        Quit both active and standby engine
+        """
+        engines = []
+        if self.standby != None:
+            try:
+                engines.append(await self.standby)
+            except Exception:
+                pass  # never started, nothing to quit
+        if self.active != None:
+            engines.append(self.active)
+
+        for transport, protocol in engines:
+            try:
+                await asyncio.wait_for(protocol.quit(), self.grace)
+            except (asyncio.TimeoutError, chess.engine.EngineTerminatedError):
+                transport.close()
+
+        self.active = self.standby = None
+
+
 # TODO: rewrite docstring
 class ChessBoard:
     """
@@ -52,10 +253,13 @@ class ChessBoard:
         warnLED: hw.LEDmatrix,
         turnLED: Tuple[gp.LED, gp.LED],
         scanner: hw.Scanner,
-        engine: chess.engine.UciProtocol = None,
+        engine: EngineSupervisor = None,
         timeout: float = 1.0,
+        tablebase: chess.syzygy.Tablebase = None,
+        book: OpeningBook = None,
     ):
         self.board = chess.Board()
+        self.tracker = OutcomeTracker(self.board)
         self.states = [
             [GROUND] * 8,
             [GROUND] * 8,
@@ -75,6 +279,26 @@ class ChessBoard:
         self.engine = engine
         self.timeout = timeout
 
+        # opened by the caller so table handles outlive a single game
+        self.tablebase = tablebase
+        # largest piece count covered by the tablebase (e.g. "KQvK" -> 3)
+        self.tb_pieces = 0
+        if tablebase != None:
+            self.tb_pieces = max((len(t) - 1 for t in tablebase.wdl), default=0)
+
+        # opened by the caller as well, shared across games
+        self.book = book
+
+        # where AI moves came from, book misses,
+        # and seconds of engine search skipped by book hits
+        self.stats: Dict[str, float] = {
+            "engine": 0,
+            "tablebase": 0,
+            "book": 0,
+            "book_miss": 0,
+            "saved": 0.0,
+        }
+
         Pos = Tuple[int, int]
 
         # turn is occasionally set to None to block on_select()
@@ -93,13 +317,36 @@ class ChessBoard:
         self.select: Optional[Pos] = None
         # position of piece selected by engine
         self.AIselect: Optional[Pos] = None
-        # all possible legal moves on the board
-        self.legal_moves: List[chess.Move] = []
+        # in-flight run_engine() task
+        self.engine_task: Optional[asyncio.Task] = None
+        # all possible legal moves on the board, see legal_moves
+        self._legal_moves: Optional[List[chess.Move]] = []
         # positions currently selected piece can go to
         self.candidates: List[Pos] = []
+        # (lifted mask, placed mask) -> move, built from legal_moves.
+        # reset to None whenever legal_moves is set
+        self.deltas: Optional[Dict[Tuple[int, int], chess.Move]] = None
         # updated each time switch_turn() is called
         self.outcome: Optional[chess.Outcome] = None
 
+    @property
+    def legal_moves(self) -> List[chess.Move]:
+        """
+        All possible legal moves on the board.
+        Generated on first use, since AI's turn never needs them
+        """
+        if self._legal_moves == None:
+            self._legal_moves = list(self.board.legal_moves)
+        return self._legal_moves
+
+    @legal_moves.setter
+    def legal_moves(self, moves: Optional[List[chess.Move]]):
+        """
+        Set to None to generate them again on next use
+        """
+        self._legal_moves = moves
+        self.deltas = None
+
     def _led_str(self) -> List[str]:
         """
         String representation of LED matricies.
@@ -175,31 +422,144 @@ class ChessBoard:
             raise ValueError(f"No piece at {(x, y)}")
         return piece.color
 
-    async def run_engine(self):
+    def probe_book(self) -> Optional[chess.Move]:
         """
-        1. Run UCI engine & get the result
-        2. Highlight from_square of the result
-        3. Limit legal_moves to single move (engine result)
+        Pick a move from opening book.
+        Return None if there's no book or the game left the book
+        """
+        if self.book == None:
+            return None
+
+        start = time.perf_counter()
+        try:
+            move = self.book.lookup(self.board)
+        except OSError as e:
+            logger.warning(f"Opening book failed: {repr(e)}")
+            return None
+        if move == None:
+            self.stats["book_miss"] += 1
+            return None
+        if move.promotion not in (None, chess.QUEEN):
+            return None  # always promoted to Queen, see on_move()
+
+        self.stats["book"] += 1
+        self.stats["saved"] += max(0.0, self.timeout - (time.perf_counter() - start))
+        hits, misses = self.stats["book"], self.stats["book_miss"]
+        logger.debug(
+            f"Book hit ({hits / (hits + misses):.0%} hit rate, "
+            f"{self.stats['saved']:.1f}s saved)"
+        )
+        return move
+
+    def probe_tablebase(self) -> Optional[chess.Move]:
         """
-        logger.debug("Running uci engine")
-        assert self.engine != None
+        Pick the best move from Syzygy tablebase.
+        Return None if the position isn't covered by the tables
+        """
+        if self.tablebase == None:
+            return None
+        if chess.popcount(self.board.occupied) > self.tb_pieces:
+            return None
+
+        # ply count toward the fifty-move rule before our move
+        clock = self.board.halfmove_clock
+
+        best, best_key = None, None
+        try:
+            # board is pushed & popped below, don't iterate it lazily
+            for move in list(self.board.legal_moves):
+                if move.promotion not in (None, chess.QUEEN):
+                    continue  # always promoted to Queen, see on_move()
+                self.board.push(move)
+                try:
+                    if self.board.is_checkmate():
+                        return move
+                    # dtz: our plies until zeroing, this move included
+                    if self.board.halfmove_clock == 0:
+                        # capture or pawn move zeroes right away,
+                        # dtz after it counts toward the next fifty moves
+                        wdl = -self.tablebase.probe_wdl(self.board)
+                        dtz = {2: 1, 1: 101, 0: 0, -1: -101, -2: -1}[wdl]
+                    else:
+                        dtz = -self.tablebase.probe_dtz(self.board)
+                        dtz += (dtz > 0) - (dtz < 0)
+                finally:
+                    self.board.pop()
+
+                # win / loss only holds if zeroing comes within fifty moves.
+                # win fast (lowest dtz), lose slow (highest -dtz)
+                if dtz > 0:
+                    key = (2 if dtz + clock <= 100 else 1, -dtz)
+                elif dtz < 0:
+                    key = (-2 if -dtz + clock <= 100 else -1, -dtz)
+                else:
+                    key = (0, 0)
 
-        limit = chess.engine.Limit(time=self.timeout)
-        result = await self.engine.play(self.board, limit=limit)
+                if best_key == None or key > best_key:
+                    best, best_key = move, key
+        except KeyError:  # missing table, castling rights, etc.
+            return None
+        except OSError as e:
+            logger.warning(f"Tablebase failed: {repr(e)}")
+            return None
 
-        if not result.move:
-            # engine gave up for some reason?
-            logger.debug(f"Engine result: {repr(result)}")
-            raise RuntimeError("Engine result doesn't contain any move")
+        return best
 
-        square = result.move.from_square
+    async def run_engine(self):
+        """
+        1. Probe book & tablebase, or run UCI engine & get the result
+        2. Highlight from_square of the result
+        3. Limit legal_moves to single move (engine result)
+        """
+        move = self.probe_book()
+        if move == None:
+            move = self.probe_tablebase()
+            if move != None:
+                self.stats["tablebase"] += 1
+                logger.debug(f"Tablebase hit ({self.stats['tablebase']} total)")
+
+        if move == None:
+            logger.debug("Running uci engine")
+            assert self.engine != None
+
+            limit = chess.engine.Limit(time=self.timeout)
+            result = await self.engine.play(self.board, limit=limit)
+
+            if not result.move:
+                # engine gave up for some reason?
+                logger.debug(f"Engine result: {repr(result)}")
+                raise RuntimeError("Engine result doesn't contain any move")
+            move = result.move
+            self.stats["engine"] += 1
+
+        square = move.from_square
         x, y = square % 8, square // 8
-        self.legal_moves = [result.move]
+        self.legal_moves = [move]
         self.AIselect = (x, y)
         self.goodLED.on(x, y)
 
         self.turn = chess.BLACK  # unblock selection
-        logger.debug(f"Engine returned {result.move.uci()}")
+        logger.debug(f"AI returned {move.uci()}")
+
+    def _engine_done(self, task: asyncio.Task):
+        """
+        Callback of engine_task. When run_engine() failed,
+        report it and let AI's move be made by hand
+        instead of blocking selection forever
+        """
+        if self.engine_task is task:
+            self.engine_task = None
+        if task.cancelled():
+            return
+        exc = task.exception()
+        if exc == None:
+            return
+
+        logger.error(f"run_engine() failed: {repr(exc)}")
+        if self.turn == None and self.outcome == None:
+            logger.warning("AI move has to be made by hand")
+            self.legal_moves = None
+            self.turn = chess.BLACK  # unblock selection
 
     @event
     def switch_turn(self):
@@ -208,7 +568,7 @@ class ChessBoard:
         2. Update turnLED state
         3. If engine is given & AI's turn, run_engine is called
         """
-        self.outcome = self.board.outcome()
+        self.outcome = self.tracker.outcome()
         if self.outcome != None:
             self.legal_moves = []
             return
@@ -216,12 +576,13 @@ class ChessBoard:
         self.turn = not self.turn
         self.turnLED[self.turn].on()
         self.turnLED[not self.turn].off()
-        self.legal_moves = list(self.board.legal_moves)
+        self.legal_moves = None
 
         if self.engine != None:
             if self.turn == chess.BLACK:  # AI's turn
                 self.turn = None  # Block selection untill engine returns
-                asyncio.create_task(self.run_engine())
+                self.engine_task = asyncio.create_task(self.run_engine())
+                self.engine_task.add_done_callback(self._engine_done)
             elif self.turn == chess.WHITE and self.AIselect:
                 self.goodLED.off(*self.AIselect)
                 self.AIselect = None
@@ -412,7 +773,7 @@ class ChessBoard:
 
         # Normally switch_turn() is called after moving,
         # but moves that manipulate 2 pieces set 'pending' state instead
-        self.board.push(move)
+        self.tracker.push(move)
         if self.pending:
             logger.debug("Move requires 2+ actions. 'pending' state set")
         else:
@@ -441,7 +802,7 @@ class ChessBoard:
         self.lifted[self.turn].remove((from_x, from_y))
         self.states[from_y][from_x] = EMPTY
 
-        self.board.push(move)
+        self.tracker.push(move)
         self.switch_turn()
 
     @event
@@ -497,3 +858,181 @@ class ChessBoard:
             self.on_lift(x, y)
         else:
             self.on_place(x, y)
+
+    def _build_deltas(self) -> Dict[Tuple[int, int], chess.Move]:
+        """
+        Occupancy change (lifted mask, placed mask) of every legal move.
+        Captures place nothing (victim square stays occupied), which looks
+        the same as just lifting the killer, so they're left to toggle().
+        Deltas shared by several moves are dropped, since they're ambiguous
+        """
+        deltas: Dict[Tuple[int, int], Optional[chess.Move]] = {}
+        before = self.board.occupied
+        for move in self.legal_moves:
+            if move.promotion not in (None, chess.QUEEN):
+                continue  # always promoted to Queen, see on_move()
+            self.board.push(move)
+            after = self.board.occupied
+            self.board.pop()
+
+            lifted, placed = before & ~after, after & ~before
+            if not placed:
+                continue
+            key = (lifted, placed)
+            deltas[key] = None if key in deltas else move
+
+        return {k: m for k, m in deltas.items() if m != None}
+
+    @event
+    def on_resolve(self, move: chess.Move):
+        """
+        When a whole scan matches occupancy change of a legal move,
+        or a capture of the piece that's already removed
+
+        Update every affected square at once and switch turn
+        """
+        x, y = move.to_square % 8, move.to_square // 8
+        if self.states[y][x] == MISSING:  # victim removed beforehand
+            assert self.turn != None
+            self.lifted[not self.turn].remove((x, y))
+            self.errors -= 1
+            self.warnLED.off(x, y)
+            self.states[y][x] = GROUND
+
+        before = self.board.occupied
+        self.tracker.push(move)
+        after = self.board.occupied
+
+        for square in chess.SquareSet(before & ~after):
+            self.states[square // 8][square % 8] = EMPTY
+        for square in chess.SquareSet(after & ~before):
+            self.states[square // 8][square % 8] = GROUND
+
+        self.switch_turn()
+
+    def resync(self) -> List[Tuple[int, int]]:
+        """
+        Rebuild states, lifted, errors and warnLED
+        by comparing the whole scanner snapshot with the board.
+        Return squares whose state was out of sync.
+        Nothing is touched if the snapshot already matches
+
+        Raise ValueError if scanner doesn't cover the whole 8x8 board
+        """
+        sensed = np.asarray(self.scanner.data, dtype=bool)
+        if sensed.shape != (8, 8):
+            raise ValueError(f"Scanner covers {sensed.shape}, not (8, 8) squares")
+
+        squares = np.arange(64, dtype=np.uint64)
+        occupied = np.uint64(self.board.occupied)
+        expected = ((occupied >> squares) & np.uint64(1)).astype(bool).reshape(8, 8)
+        wrong = expected ^ sensed
+
+        # EMPTY, GROUND, MISSING, MISPLACE are 0, 1, 2, 3
+        rebuilt = sensed.astype(int) + wrong * 2
+
+        states = np.array(self.states, dtype=int)
+        current = states.copy()
+        if self.select != None:
+            x, y = self.select
+            current[y][x] = MISSING  # lifted selection is not a drift
+        drift = [(int(x), int(y)) for y, x in zip(*np.nonzero(rebuilt != current))]
+
+        if not drift:
+            # states are right, check counters derived from them
+            errors = int(np.isin(states, [MISSING, MISPLACE]).sum())
+            lifted = (set(), set())
+            for y, x in zip(*np.nonzero(np.isin(states, [MISSING, SELECT]))):
+                x, y = int(x), int(y)
+                lifted[self.color_at(x, y)].add((x, y))
+
+            if errors == self.errors and lifted == self.lifted:
+                # also keeps a fresh board waiting for the lift & return
+                return drift
+            logger.warning("Resync: errors / lifted out of sync")
+
+        if self.select != None:
+            self.on_unselect()
+
+        self.states = [[State(int(col)) for col in row] for row in rebuilt]
+        self.errors = int(wrong.sum())
+        for y in range(8):
+            self.warnLED.data[y][:] = wrong[y]
+
+        self.lifted = (set(), set())
+        for y, x in zip(*np.nonzero(expected & ~sensed)):
+            x, y = int(x), int(y)
+            self.lifted[self.color_at(x, y)].add((x, y))
+
+        selectable = self.turn != None and not self.pending
+        if selectable and len(self.lifted[self.turn]) == 1:
+            new_select = next(iter(self.lifted[self.turn]))
+            self.errors -= 1
+            self.warnLED.off(*new_select)
+            self.on_select(*new_select)
+
+        if drift:
+            logger.warning(f"Resync: {len(drift)} square(s) out of sync {drift}")
+
+        if self.pending and self.errors == 0:
+            logger.debug("All errors resolved. No longer pending.")
+            self.pending = False
+            self.switch_turn()
+
+        return drift
+
+    def _find_capture(
+        self, lifted: int, victim: Tuple[int, int]
+    ) -> Optional[chess.Move]:
+        """
+        Legal move capturing the piece at victim
+        with the single piece lifted in the scan
+        """
+        if chess.popcount(lifted) != 1:
+            return None
+        from_square = chess.lsb(lifted)
+        to_square = chess.square(*victim)
+        for move in self.legal_moves:
+            if move.from_square == from_square and move.to_square == to_square:
+                if move.promotion in (None, chess.QUEEN):
+                    return move
+        return None
+
+    def apply_scan(self, changes: List[Tuple[int, int]]):
+        """
+        Interpret every change of a single scan together.
+        If it resolves to a legal move, the move is played at once.
+        Otherwise each change is handled by toggle(), lifts first
+        """
+        if not changes:
+            return
+
+        lifts = [(x, y) for x, y in changes if self.states[y][x] & State.GROUND]
+        places = [(x, y) for x, y in changes if not self.states[y][x] & State.GROUND]
+
+        ready = self.turn != None and not self.pending and self.select == None
+        if ready:
+            lifted = placed = 0
+            for x, y in lifts:
+                lifted |= chess.BB_SQUARES[chess.square(x, y)]
+            for x, y in places:
+                placed |= chess.BB_SQUARES[chess.square(x, y)]
+
+            move = None
+            if self.errors == 0:
+                if self.deltas == None:
+                    self.deltas = self._build_deltas()
+                move = self.deltas.get((lifted, placed))
+            elif self.errors == 1 and len(self.lifted[not self.turn]) == 1:
+                # only error is the victim, removed in an earlier scan
+                victim = next(iter(self.lifted[not self.turn]))
+                if placed == chess.BB_SQUARES[chess.square(*victim)]:
+                    move = self._find_capture(lifted, victim)
+
+            if move != None:
+                self.on_resolve(move)
+                return
+
+        # a lift may select the piece that the following placement moves
+        for x, y in lifts + places:
+            self.toggle(x, y)
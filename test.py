@@ -18,14 +18,18 @@ async def test():
     blue = hw.LEDmatrix()
     turn = hw.VirtualLED(), hw.VirtualLED()
     scanner = hw.ConsoleInput(";) ")
-    _, engine = await chess.engine.popen_uci("./stockfish")
+    engine = sw.EngineSupervisor("./stockfish")
+    await engine.start()
 
     game = sw.ChessBoard(blue, red, turn, scanner, engine)
 
     while game.outcome == None:
-        for x, y in await scanner.scan():
-            game.toggle(x, y)
-            print(game, end="\n\n")
+        changes = await scanner.scan()
+        if changes:
+            game.apply_scan(changes)
+        else:  # empty input: resync with the whole board
+            game.resync()
+        print(game, end="\n\n")
 
     await engine.quit()
 